@@ -27,12 +27,42 @@ from qgis.core import (QgsProcessing,
                        QgsCoordinateReferenceSystem)
 from qgis.PyQt.QtCore import QVariant
 import os
-import shutil
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
-import zipfile
-import tempfile
-from datetime import datetime
+from .photo_writer import write_photos
+# Pillow, NumPy and the archive modules are imported where they are used,
+# keeping plugin load at QGIS startup cheap
+
+# Number of images handed to the worker pool between cancel checks
+BATCH_SIZE = 64
+
+# Supported image extensions
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.tiff', '.tif')
+
+# File signatures, the JPEG one is SOI followed by the next marker prefix
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')  # TIFF and BigTIFF
+
+# JPEG markers
+JPEG_APP1 = 0xE1
+JPEG_SOS = 0xDA
+
+POINT_PLACEMARK = """    <Placemark>
+      <name>%(name)s</name>
+      <description><![CDATA[%(description)s]]></description>
+      <Point>
+        <coordinates>%(lon)s,%(lat)s,0</coordinates>
+      </Point>
+    </Placemark>
+"""
+
+# EXIF tag ids, see the EXIF 2.3 specification
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+TAG_DATETIME = 0x0132
+TAG_DATETIME_ORIGINAL = 0x9003
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
 
 class GeotaggedImagesToKmzAlgorithm(QgsProcessingAlgorithm):
     
@@ -108,66 +138,89 @@ class GeotaggedImagesToKmzAlgorithm(QgsProcessingAlgorithm):
             )
         )
     
+    def read_jpeg_exif(self, f):
+        """Return the raw EXIF segment of an open JPEG file without decoding the image"""
+        # Skip SOI, then walk the marker segments up to the start of the image data
+        f.seek(2)
+        while True:
+            header = f.read(4)
+            if len(header) < 4 or header[0] != 0xFF or header[1] == JPEG_SOS:
+                return None
+            
+            length = int.from_bytes(header[2:4], 'big')
+            if header[1] == JPEG_APP1:
+                data = f.read(length - 2)
+                if data.startswith(b'Exif\x00\x00'):
+                    return data
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+    
+    def read_exif_tags(self, exif):
+        """Return the GPS IFD and capture datetime of a Pillow Exif object"""
+        gps_data = exif.get_ifd(GPS_IFD)
+        datetime_str = (exif.get_ifd(EXIF_IFD).get(TAG_DATETIME_ORIGINAL)
+                        or exif.get(TAG_DATETIME))
+        return gps_data, datetime_str
+    
     def get_exif_data(self, image_path):
-        """Extract GPS coordinates and other EXIF data from image"""
+        """Extract the GPS IFD and capture datetime from image EXIF data"""
+        from PIL import Image
+        
         try:
-            image = Image.open(image_path)
-            exif_data = image._getexif()
-            
-            if exif_data is not None:
-                result = {}
-                for tag, value in exif_data.items():
-                    tag_name = TAGS.get(tag, tag)
-                    if tag_name == 'GPSInfo':
-                        gps_data = {}
-                        for gps_tag in value:
-                            sub_tag_name = GPSTAGS.get(gps_tag, gps_tag)
-                            gps_data[sub_tag_name] = value[gps_tag]
-                        result['GPSInfo'] = gps_data
-                    elif tag_name == 'DateTime':
-                        result['DateTime'] = value
-                    elif tag_name == 'DateTimeOriginal':
-                        result['DateTimeOriginal'] = value
-                return result
+            with open(image_path, 'rb') as f:
+                # Sniff the file type so that other or corrupt files are
+                # skipped without being handed to Pillow
+                head = f.read(4)
+                
+                if head.startswith(JPEG_SIGNATURE):
+                    data = self.read_jpeg_exif(f)
+                    if data is None:
+                        return None
+                    exif = Image.Exif()
+                    exif.load(data)
+                    return self.read_exif_tags(exif)
+                
+                if head in TIFF_SIGNATURES:
+                    # TIFF tags are read lazily from the open file
+                    f.seek(0)
+                    with Image.open(f) as image:
+                        return self.read_exif_tags(image.getexif())
         except Exception:
             pass
         return None
     
-    def convert_to_degrees(self, value):
-        """Convert GPS coordinates to decimal degrees"""
-        d, m, s = value
-        return d + (m / 60.0) + (s / 3600.0)
+    def convert_to_degrees(self, values, refs, positive_ref):
+        """Convert GPS (degrees, minutes, seconds) values to signed decimal degrees"""
+        import numpy as np
+        
+        dms = np.asarray(values, dtype=np.float64)
+        degrees = dms[:, 0] + (dms[:, 1] / 60.0) + (dms[:, 2] / 3600.0)
+        return np.where(np.asarray(refs) == positive_ref, degrees, -degrees)
     
     def get_coordinates(self, exif_data):
-        """Extract latitude and longitude from EXIF data"""
-        if not exif_data or 'GPSInfo' not in exif_data:
-            return None, None
+        """Extract raw latitude and longitude values and references from EXIF data"""
+        if not exif_data or not exif_data[0]:
+            return None
             
-        gps_data = exif_data['GPSInfo']
-        lat = gps_data.get('GPSLatitude')
-        lat_ref = gps_data.get('GPSLatitudeRef')
-        lon = gps_data.get('GPSLongitude')
-        lon_ref = gps_data.get('GPSLongitudeRef')
+        gps_data = exif_data[0]
+        lat = gps_data.get(GPS_LATITUDE)
+        lat_ref = gps_data.get(GPS_LATITUDE_REF)
+        lon = gps_data.get(GPS_LONGITUDE)
+        lon_ref = gps_data.get(GPS_LONGITUDE_REF)
         
-        if lat and lon and lat_ref and lon_ref:
-            lat = self.convert_to_degrees(lat)
-            if lat_ref != 'N':
-                lat = -lat
-                
-            lon = self.convert_to_degrees(lon)
-            if lon_ref != 'E':
-                lon = -lon
-                
-            return lat, lon
-        return None, None
+        if lat and lon and lat_ref and lon_ref and len(lat) == 3 and len(lon) == 3:
+            return lat, lat_ref, lon, lon_ref
+        return None
     
     def get_datetime(self, exif_data):
         """Extract datetime from EXIF data"""
+        from datetime import datetime
+        
         if not exif_data:
             return None
             
-        # Try DateTimeOriginal first, then DateTime
-        datetime_str = exif_data.get('DateTimeOriginal') or exif_data.get('DateTime')
+        # DateTimeOriginal, falling back to DateTime
+        datetime_str = exif_data[1]
         if datetime_str:
             try:
                 # Convert EXIF datetime format to readable format
@@ -177,107 +230,119 @@ class GeotaggedImagesToKmzAlgorithm(QgsProcessingAlgorithm):
                 return datetime_str
         return None
     
+    def extract_image_info(self, entry):
+        """Read raw GPS position and datetime of a single image directory entry"""
+        exif_data = self.get_exif_data(entry.path)
+        return self.get_coordinates(exif_data), self.get_datetime(exif_data)
+    
     def create_kml_content(self, features, layer_name):
-        """Create KML content from features"""
-        kml_content = f"""<?xml version="1.0" encoding="UTF-8"?>
+        """Create the list of KML document parts from features"""
+        kml_parts = [f"""<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
   <Document>
     <name>{layer_name}</name>
     <description>Geotagged Photos</description>
-"""
+"""]
+        append = kml_parts.append
         
         for feature in features:
-            name = feature['name']
-            description = feature['description']
             lat, lon = feature['coordinates']
-            
-            kml_content += f"""    <Placemark>
-      <name>{name}</name>
-      <description><![CDATA[{description}]]></description>
-      <Point>
-        <coordinates>{lon},{lat},0</coordinates>
-      </Point>
-    </Placemark>
-"""
+            append(POINT_PLACEMARK % {
+                'name': feature['name'],
+                'description': feature['description'],
+                'lat': lat,
+                'lon': lon
+            })
         
-        kml_content += """  </Document>
-</kml>"""
-        return kml_content
+        append("""  </Document>
+</kml>""")
+        return kml_parts
     
     def processAlgorithm(self, parameters, context, feedback):
         """
         Process the algorithm.
         """
+        import io
+        import zipfile
+        from concurrent.futures import ThreadPoolExecutor
+        
         input_folder = self.parameterAsFile(parameters, self.INPUT_FOLDER, context)
         output_kmz = self.parameterAsFileOutput(parameters, self.OUTPUT_KMZ, context)
         layer_name = self.parameterAsString(parameters, self.LAYER_NAME, context)
         
-        # Supported image extensions
-        image_extensions = ['.jpg', '.jpeg', '.tiff', '.tif']
+        # Directory entries carry the name and full path, and on Windows the
+        # file stat too, so no further lookups are needed per image
+        with os.scandir(input_folder) as entries:
+            images = [entry for entry in entries
+                      if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file()]
         
         features = []
-        processed_count = 0
+        photos = []
         
-        # Create temporary directory for organizing files
-        temp_dir = tempfile.mkdtemp()
-        photos_dir = os.path.join(temp_dir, 'Photos')
-        os.makedirs(photos_dir, exist_ok=True)
+        # Raw GPS values, converted to decimal degrees for all images at once
+        lats_dms, lat_refs, lons_dms, lon_refs = [], [], [], []
+        processed_count = 0
         
-        try:
-            # Process images in the folder
-            for filename in os.listdir(input_folder):
-                if any(filename.lower().endswith(ext) for ext in image_extensions):
-                    image_path = os.path.join(input_folder, filename)
-                    
+        # Read EXIF data of the images in parallel, in batches so that
+        # cancellation is checked regularly
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for start in range(0, len(images), BATCH_SIZE):
+                if feedback.isCanceled():
+                    break
+                
+                batch = images[start:start + BATCH_SIZE]
+                for entry, (position, datetime_str) in zip(
+                        batch, executor.map(self.extract_image_info, batch)):
+                    filename = entry.name
                     feedback.pushInfo(f'Processing: {filename}')
                     
-                    exif_data = self.get_exif_data(image_path)
-                    lat, lon = self.get_coordinates(exif_data)
-                    
-                    if lat is not None and lon is not None:
-                        # Get datetime from EXIF
-                        datetime_str = self.get_datetime(exif_data)
+                    if position is not None:
+                        lat, lat_ref, lon, lon_ref = position
+                        lats_dms.append(lat)
+                        lat_refs.append(lat_ref)
+                        lons_dms.append(lon)
+                        lon_refs.append(lon_ref)
                         
+                        datetime_str = datetime_str or 'Unknown'
                         feature = {
                             'name': os.path.splitext(filename)[0],
                             'filename': filename,
-                            'datetime': datetime_str or 'Unknown',
-                            'coordinates': (lat, lon)
+                            'datetime': datetime_str,
+                            'description': (f'<p>Date taken: {datetime_str}</p>'
+                                            f'<img src="Photos/{filename}" style="max-width:720px;" />')
                         }
                         features.append(feature)
                         
-                        # Copy image to Photos directory
-                        dest_path = os.path.join(photos_dir, filename)
-                        shutil.copy2(image_path, dest_path)
+                        # Image is added to the KMZ straight from the source folder
+                        photos.append((entry.path, f'Photos/{filename}'))
                         
                         processed_count += 1
                     else:
                         feedback.pushInfo(f'No GPS data found in: {filename}')
-            
-            if not features:
-                raise QgsProcessingException('No geotagged images found in the specified folder.')
-            
-            # Create KML content
-            kml_content = self.create_kml_content(features, layer_name)
-            
-            # Write KML file to temp directory
-            kml_path = os.path.join(temp_dir, 'doc.kml')
-            with open(kml_path, 'w', encoding='utf-8') as kml_file:
-                kml_file.write(kml_content)
-            
-            # Create KMZ file with photos
-            with zipfile.ZipFile(output_kmz, 'w', zipfile.ZIP_DEFLATED) as kmz:
-                # Add KML file
-                kmz.write(kml_path, 'doc.kml')
                 
-                # Add all photos
-                for filename in os.listdir(photos_dir):
-                    photo_path = os.path.join(photos_dir, filename)
-                    kmz.write(photo_path, f'Photos/{filename}')
-                    
-        finally:
-            # Clean up temporary directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
+                feedback.setProgress(int((start + len(batch)) * 90 / len(images)))
+        
+        if not features:
+            raise QgsProcessingException('No geotagged images found in the specified folder.')
+        
+        lats = self.convert_to_degrees(lats_dms, lat_refs, 'N')
+        lons = self.convert_to_degrees(lons_dms, lon_refs, 'E')
+        for feature, lat, lon in zip(features, lats.tolist(), lons.tolist()):
+            feature['coordinates'] = (lat, lon)
+        
+        # Create KML content
+        kml_parts = self.create_kml_content(features, layer_name)
+        
+        # Create KMZ file with photos
+        # The images are already compressed, only the KML is deflated
+        with zipfile.ZipFile(output_kmz, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as kmz:
+            # Stream the KML straight into the archive
+            with io.TextIOWrapper(kmz.open('doc.kml', 'w', force_zip64=True), encoding='utf-8') as kml_file:
+                kml_file.writelines(kml_parts)
+            
+            # Add all photos
+            write_photos(kmz, [(photo_path, arcname, zipfile.ZIP_STORED)
+                               for photo_path, arcname in photos])
         
         feedback.pushInfo(f'Successfully processed {processed_count} geotagged images')
         feedback.pushInfo(f'KMZ file created with embedded photos: {output_kmz}')
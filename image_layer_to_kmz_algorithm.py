@@ -20,16 +20,57 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterString,
                        QgsProcessingParameterBoolean,
                        QgsWkbTypes,
-                       QgsCoordinateTransform,
-                       QgsCoordinateReferenceSystem,
-                       QgsProject)
+                       QgsFeatureRequest,
+                       QgsCoordinateReferenceSystem)
 from qgis.PyQt.QtCore import QVariant
 from qgis.PyQt.QtCore import QDateTime
 import os
-import shutil
-import zipfile
-import tempfile
-from xml.sax.saxutils import escape
+from .photo_writer import write_photos
+
+# Same entities as xml.sax.saxutils.escape, applied in a single pass
+XML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# Already compressed image formats, stored in the KMZ without deflating
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.tif', '.tiff', '.png')
+
+# Placemark templates per geometry type, filled with %-formatting
+POINT_PLACEMARK = """    <Placemark>
+      <name>%(name)s</name>
+      <description><![CDATA[%(description)s]]></description>
+      <Point>
+        <coordinates>%(coordinates)s</coordinates>
+      </Point>
+    </Placemark>
+"""
+
+LINESTRING_PLACEMARK = """    <Placemark>
+      <name>%(name)s</name>
+      <description><![CDATA[%(description)s]]></description>
+      <LineString>
+        <coordinates>%(coordinates)s</coordinates>
+      </LineString>
+    </Placemark>
+"""
+
+POLYGON_PLACEMARK = """    <Placemark>
+      <name>%(name)s</name>
+      <description><![CDATA[%(description)s]]></description>
+      <Polygon>
+        <outerBoundaryIs>
+          <LinearRing>
+            <coordinates>%(coordinates)s</coordinates>
+          </LinearRing>
+        </outerBoundaryIs>
+      </Polygon>
+    </Placemark>
+"""
+
+# Used for geometry types without a KML representation
+GEOMETRYLESS_PLACEMARK = """    <Placemark>
+      <name>%(name)s</name>
+      <description><![CDATA[%(description)s]]></description>
+    </Placemark>
+"""
 
 class LayerToKmzWithPhotosAlgorithm(QgsProcessingAlgorithm):
     
@@ -113,59 +154,40 @@ class LayerToKmzWithPhotosAlgorithm(QgsProcessingAlgorithm):
         # Handle both forward and backward slashes
         return os.path.basename(file_path.replace('\\', '/'))
     
-    def geometry_to_kml_coordinates(self, geometry, transform=None):
-        """Convert geometry to KML coordinates string"""
-        if transform:
-            geometry.transform(transform)
-        
-        geom_type = geometry.wkbType()
-        
-        if geom_type in [QgsWkbTypes.Point, QgsWkbTypes.PointZ, QgsWkbTypes.Point25D]:
-            point = geometry.asPoint()
-            return f"{point.x()},{point.y()},0"
-        elif geom_type in [QgsWkbTypes.LineString, QgsWkbTypes.LineStringZ, QgsWkbTypes.LineString25D]:
-            coords = []
-            for point in geometry.asPolyline():
-                coords.append(f"{point.x()},{point.y()},0")
-            return " ".join(coords)
-        elif geom_type in [QgsWkbTypes.Polygon, QgsWkbTypes.PolygonZ, QgsWkbTypes.Polygon25D]:
-            polygon = geometry.asPolygon()
-            if polygon:
-                coords = []
-                for point in polygon[0]:  # Outer ring
-                    coords.append(f"{point.x()},{point.y()},0")
-                return " ".join(coords)
-        
+    def point_to_kml_coordinates(self, geometry):
+        """Convert point geometry to KML coordinates string"""
+        point = geometry.asPoint()
+        return f"{point.x()},{point.y()},0"
+    
+    def line_to_kml_coordinates(self, geometry):
+        """Convert line geometry to KML coordinates string"""
+        return " ".join([f"{point.x()},{point.y()},0" for point in geometry.asPolyline()])
+    
+    def polygon_to_kml_coordinates(self, geometry):
+        """Convert polygon geometry outer ring to KML coordinates string"""
+        polygon = geometry.asPolygon()
+        if polygon:
+            return " ".join([f"{point.x()},{point.y()},0" for point in polygon[0]])
         return ""
     
-    def geometry_to_kml_element(self, geometry, transform=None):
-        """Convert geometry to appropriate KML element"""
-        if transform:
-            geometry.transform(transform)
-        
-        geom_type = geometry.wkbType()
-        coordinates = self.geometry_to_kml_coordinates(geometry)
+    def no_kml_coordinates(self, geometry):
+        """Coordinates for geometry types without a KML representation"""
+        return ""
+    
+    def placemark_format(self, geom_type):
+        """Return the placemark template and coordinates function for a geometry type"""
+        flat_type = QgsWkbTypes.flatType(geom_type)
         
-        if geom_type in [QgsWkbTypes.Point, QgsWkbTypes.PointZ, QgsWkbTypes.Point25D]:
-            return f"""      <Point>
-        <coordinates>{coordinates}</coordinates>
-      </Point>"""
-        elif geom_type in [QgsWkbTypes.LineString, QgsWkbTypes.LineStringZ, QgsWkbTypes.LineString25D]:
-            return f"""      <LineString>
-        <coordinates>{coordinates}</coordinates>
-      </LineString>"""
-        elif geom_type in [QgsWkbTypes.Polygon, QgsWkbTypes.PolygonZ, QgsWkbTypes.Polygon25D]:
-            return f"""      <Polygon>
-        <outerBoundaryIs>
-          <LinearRing>
-            <coordinates>{coordinates}</coordinates>
-          </LinearRing>
-        </outerBoundaryIs>
-      </Polygon>"""
+        if flat_type == QgsWkbTypes.Point:
+            return POINT_PLACEMARK, self.point_to_kml_coordinates
+        elif flat_type == QgsWkbTypes.LineString:
+            return LINESTRING_PLACEMARK, self.line_to_kml_coordinates
+        elif flat_type == QgsWkbTypes.Polygon:
+            return POLYGON_PLACEMARK, self.polygon_to_kml_coordinates
         
-        return ""
+        return GEOMETRYLESS_PLACEMARK, self.no_kml_coordinates
     
-    def create_feature_description(self, feature, photo_field, filename, include_attributes):
+    def create_feature_description(self, attributes, fields, filename, include_attributes):
         description_parts = []
         
         # Add attributes table if requested
@@ -173,13 +195,13 @@ class LayerToKmzWithPhotosAlgorithm(QgsProcessingAlgorithm):
             description_parts.append("<table border='1' style='border-collapse: collapse;'>")
             description_parts.append("<tr><th>Attribute</th><th>Value</th></tr>")
             
-            for field_name in feature.fields().names():
-                if field_name != photo_field:  # Don't include the full photo path
-                    value = feature[field_name]
-                    if isinstance(value, QDateTime):
-                        value = value.toString("yyyy-MM-dd HH:mm:ss")
-                    if value is not None:
-                        description_parts.append(f"<tr><td>{escape(str(field_name))}</td><td>{escape(str(value))}</td></tr>")
+            for field_idx, field_name in fields:
+                value = attributes[field_idx]
+                if isinstance(value, QDateTime):
+                    value = value.toString("yyyy-MM-dd HH:mm:ss")
+                if value is not None:
+                    description_parts.append(f"<tr><td>{str(field_name).translate(XML_ESCAPE_TABLE)}</td>"
+                                             f"<td>{str(value).translate(XML_ESCAPE_TABLE)}</td></tr>")
             
             description_parts.append("</table>")
             description_parts.append("<br/>")
@@ -190,58 +212,10 @@ class LayerToKmzWithPhotosAlgorithm(QgsProcessingAlgorithm):
         
         return "".join(description_parts)
     
-    def create_kml_content(self, layer, photo_field, layer_name, include_attributes, transform, copied_photos):
-        kml_content = f"""<?xml version="1.0" encoding="UTF-8"?>
-<kml xmlns="http://www.opengis.net/kml/2.2">
-  <Document>
-    <name>{escape(layer_name)}</name>
-    <description>Layer exported with photos</description>
-"""
-        
-        # Process features
-        for feature in layer.getFeatures():
-            geometry = feature.geometry()
-            if geometry.isEmpty():
-                continue
-            
-            # Get photo path and filename
-            photo_path = feature[photo_field] if photo_field in feature.fields().names() else None
-            filename = None
-            
-            if photo_path and str(photo_path).strip():
-                filename = self.get_filename_from_path(str(photo_path))
-                if filename and filename in copied_photos:
-                    # Photo was successfully copied
-                    pass
-                else:
-                    # Photo wasn't copied, don't reference it
-                    filename = None
-            
-            # Create feature name (use first non-photo field or feature ID)
-            feature_name = f"Feature {feature.id()}"
-            for field_name in feature.fields().names():
-                if field_name != photo_field and feature[field_name] is not None:
-                    feature_name = str(feature[field_name])
-                    break
-            
-            # Create description
-            description = self.create_feature_description(feature, photo_field, filename, include_attributes)
-            
-            # Get geometry element
-            geometry_element = self.geometry_to_kml_element(geometry, transform)
-            
-            kml_content += f"""    <Placemark>
-      <name>{escape(feature_name)}</name>
-      <description><![CDATA[{description}]]></description>
-{geometry_element}
-    </Placemark>
-"""
-        
-        kml_content += """  </Document>
-</kml>"""
-        return kml_content
-    
     def processAlgorithm(self, parameters, context, feedback):
+        import io
+        import zipfile
+        
         input_layer = self.parameterAsVectorLayer(parameters, self.INPUT_LAYER, context)
         photo_field = self.parameterAsString(parameters, self.PHOTO_FIELD, context)
         output_kmz = self.parameterAsFileOutput(parameters, self.OUTPUT_KMZ, context)
@@ -258,79 +232,118 @@ class LayerToKmzWithPhotosAlgorithm(QgsProcessingAlgorithm):
         if photo_field not in input_layer.fields().names():
             raise QgsProcessingException(f'Photo field "{photo_field}" not found in layer')
         
-        # Create coordinate transform to WGS84 (required for KML)
-        source_crs = input_layer.crs()
+        # Features are fetched in WGS84 (required for KML), the provider
+        # iterator reprojects them in bulk. The single pass below needs the
+        # geometry and every attribute (the placemark name is taken from the
+        # first non-empty field), so no attribute subset or NoGeometry flag
+        # is set on the request.
         dest_crs = QgsCoordinateReferenceSystem('EPSG:4326')
-        transform = None
-        if source_crs != dest_crs:
-            transform = QgsCoordinateTransform(source_crs, dest_crs, QgsProject.instance())
+        request = QgsFeatureRequest().setDestinationCrs(dest_crs, context.transformContext())
         
-        # Create temporary directory for organizing files
-        temp_dir = tempfile.mkdtemp()
-        photos_dir = os.path.join(temp_dir, 'Photos')
-        os.makedirs(photos_dir, exist_ok=True)
-        
-        copied_photos = set()
+        # Photo filename -> source path, photos are added to the KMZ straight
+        # from their source location
+        copied_photos = {}
+        # Photo path -> referenced filename (None if missing), so features
+        # sharing a photo only check it once
+        checked_paths = {}
         total_features = input_layer.featureCount()
         processed_count = 0
         
-        try:
-            # First pass: copy photos
-            feedback.pushInfo('Copying photos...')
-            for feature in input_layer.getFeatures():
-                if feedback.isCanceled():
-                    break
-                
-                photo_path = feature[photo_field] if photo_field in feature.fields().names() else None
+        # Pick the placemark format once for the layer geometry type, only
+        # layers of unknown (mixed) type are dispatched per feature
+        template, to_kml_coordinates = self.placemark_format(input_layer.wkbType())
+        mixed_geometry = QgsWkbTypes.flatType(input_layer.wkbType()) == QgsWkbTypes.Unknown
+        
+        # Resolve the fields once instead of per feature, the full photo
+        # path is not included in the description
+        fields = input_layer.fields()
+        photo_idx = fields.indexOf(photo_field)
+        non_photo_fields = [(idx, name) for idx, name in enumerate(fields.names()) if idx != photo_idx]
+        
+        with zipfile.ZipFile(output_kmz, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as kmz:
+            # Single pass over the features: collect photos and stream the
+            # KML straight into the archive
+            feedback.pushInfo('Creating KML content...')
+            with io.TextIOWrapper(kmz.open('doc.kml', 'w', force_zip64=True), encoding='utf-8') as kml_file:
+                write = kml_file.write
+                write(f"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <Document>
+    <name>{layer_name.translate(XML_ESCAPE_TABLE)}</name>
+    <description>Layer exported with photos</description>
+""")
                 
-                if photo_path and str(photo_path).strip():
-                    photo_path = str(photo_path).strip()
-                    filename = self.get_filename_from_path(photo_path)
+                for feature in input_layer.getFeatures(request):
+                    if feedback.isCanceled():
+                        break
                     
-                    if filename and os.path.exists(photo_path):
-                        try:
-                            dest_path = os.path.join(photos_dir, filename)
-                            shutil.copy2(photo_path, dest_path)
-                            copied_photos.add(filename)
-                            feedback.pushInfo(f'Copied: {filename}')
-                        except Exception as e:
-                            feedback.pushInfo(f'Failed to copy {photo_path}: {str(e)}')
-                    else:
-                        if filename:
-                            feedback.pushInfo(f'Photo not found: {photo_path}')
-                
-                processed_count += 1
-                feedback.setProgress(int(processed_count * 50 / total_features))  # First 50% for copying
-            
-            feedback.pushInfo(f'Successfully copied {len(copied_photos)} photos')
-            
-            # Create KML content
-            feedback.pushInfo('Creating KML content...')
-            kml_content = self.create_kml_content(input_layer, photo_field, layer_name, 
-                                                include_attributes, transform, copied_photos)
-            
-            # Write KML file to temp directory
-            kml_path = os.path.join(temp_dir, 'doc.kml')
-            with open(kml_path, 'w', encoding='utf-8') as kml_file:
-                kml_file.write(kml_content)
-            
-            # Create KMZ file
-            feedback.pushInfo('Creating KMZ file...')
-            with zipfile.ZipFile(output_kmz, 'w', zipfile.ZIP_DEFLATED) as kmz:
-                # Add KML file
-                kmz.write(kml_path, 'doc.kml')
+                    processed_count += 1
+                    feedback.setProgress(int(processed_count * 90 / total_features))
+                    
+                    geometry = feature.geometry()
+                    if geometry.isEmpty():
+                        continue
+                    
+                    if mixed_geometry:
+                        template, to_kml_coordinates = self.placemark_format(geometry.wkbType())
+                    
+                    attributes = feature.attributes()
+                    
+                    # Get photo path and filename, only reference photos that exist
+                    photo_path = attributes[photo_idx]
+                    filename = None
+                    
+                    if photo_path and str(photo_path).strip():
+                        photo_path = str(photo_path).strip()
+                        
+                        if photo_path in checked_paths:
+                            filename = checked_paths[photo_path]
+                        else:
+                            filename = self.get_filename_from_path(photo_path)
+                            
+                            if filename in copied_photos:
+                                pass
+                            elif (filename and os.path.isfile(photo_path)
+                                  and os.access(photo_path, os.R_OK)):
+                                copied_photos[filename] = photo_path
+                                feedback.pushInfo(f'Found: {filename}')
+                            else:
+                                if filename:
+                                    feedback.pushInfo(f'Photo not found: {photo_path}')
+                                filename = None
+                            
+                            checked_paths[photo_path] = filename
+                    
+                    # Create feature name (use first non-photo field or feature ID)
+                    feature_name = f"Feature {feature.id()}"
+                    for field_idx, _ in non_photo_fields:
+                        if attributes[field_idx] is not None:
+                            feature_name = str(attributes[field_idx])
+                            break
+                    
+                    # Create description
+                    description = self.create_feature_description(attributes, non_photo_fields, filename, include_attributes)
+                    
+                    write(template % {
+                        'name': feature_name.translate(XML_ESCAPE_TABLE),
+                        'description': description,
+                        'coordinates': to_kml_coordinates(geometry)
+                    })
                 
-                # Add all photos
-                for filename in copied_photos:
-                    photo_path = os.path.join(photos_dir, filename)
-                    if os.path.exists(photo_path):
-                        kmz.write(photo_path, f'Photos/{filename}')
+                write("""  </Document>
+</kml>""")
             
-            feedback.setProgress(100)
+            feedback.pushInfo(f'Successfully found {len(copied_photos)} photos')
             
-        finally:
-            # Clean up temporary directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            # Add all photos
+            feedback.pushInfo('Adding photos to KMZ file...')
+            write_photos(kmz, [
+                (photo_path, f'Photos/{filename}',
+                 zipfile.ZIP_STORED if filename.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED)
+                for filename, photo_path in copied_photos.items()
+            ])
+        
+        feedback.setProgress(100)
         
         feedback.pushInfo(f'Successfully processed {input_layer.featureCount()} features')
         feedback.pushInfo(f'Included {len(copied_photos)} photos in KMZ')
@@ -15,13 +15,114 @@ from qgis.core import (QgsProcessing, QgsProcessingException,
                        QgsProcessingParameterCrs, QgsProcessingParameterBoolean,
                        QgsProcessingParameterFileDestination, QgsProject,
                        QgsVectorFileWriter, QgsCoordinateReferenceSystem,
-                       QgsCoordinateTransform, QgsVectorLayer, QgsRasterLayer)
+                       QgsCoordinateTransform, QgsVectorLayer, QgsRasterLayer,
+                       QgsProcessingFeedback, QgsProcessingParameterFile,
+                       QgsProcessingUtils)
 import processing
 import os
 import tempfile
 import zipfile
 import shutil
 import re
+import mmap
+import weakref
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+
+# Bytes copied at a time when adding layer Folders to the KMZ
+CHUNK_SIZE = 64 * 1024
+FOLDER_START = b'<Folder>'
+FOLDER_END = b'</Folder>'
+# Opening and closing of the master KML, already UTF-8 encoded
+KML_HEADER = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+              b'<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+              b'  <Document>\n')
+KML_FOOTER = b'  </Document>\n</kml>'
+# Characters not allowed in file names
+_INVALID_FN = re.compile(r'[<>:"/\\|?*]')
+# Feature count above which a vector layer is reprojected before writing
+REPROJECT_THRESHOLD = 50000
+# Feature count above which WGS84 coordinates are snapped to
+# SNAP_SPACING degrees (about 1 cm), keeping the KML coordinates short
+SNAP_THRESHOLD = 100000
+SNAP_SPACING = 1e-7
+# Seconds between checks for cancellation while layers are processed
+CANCEL_POLL_INTERVAL = 0.2
+# Above this many layers only errors are logged per layer, with a progress
+# summary every SUMMARY_INTERVAL layers
+QUIET_LAYER_COUNT = 500
+SUMMARY_INTERVAL = 100
+
+
+@lru_cache(maxsize=64)
+def _get_transform(src_authid, dst_authid):
+    """Return a coordinate transform between two CRS auth ids, cached so
+    layers sharing a CRS reuse the same PROJ pipeline."""
+    return QgsCoordinateTransform(
+        QgsCoordinateReferenceSystem(src_authid),
+        QgsCoordinateReferenceSystem(dst_authid),
+        QgsProject.instance()
+    )
+
+
+def _same_crs(crs, authid, other, other_authid):
+    """Compare two CRSs by their precomputed auth ids, falling back to the
+    full (WKT based) comparison when one of them is a custom CRS without
+    an auth id."""
+    if authid and other_authid:
+        return authid == other_authid
+    return crs == other
+
+
+def _has_content(path):
+    """Return True if the file exists and is not empty, with one stat call."""
+    try:
+        return os.stat(path).st_size > 0
+    except FileNotFoundError:
+        return False
+
+
+def clear_transform_cache():
+    """Drop the cached coordinate transforms."""
+    _get_transform.cache_clear()
+
+
+class _TaskLog:
+    """Collects the messages of a layer processed on a worker thread, so
+    they can be passed on to the processing feedback from the main thread.
+    
+    Its processing_feedback is given to the algorithms run for the layer,
+    so cancel() from the main thread stops them.
+    
+    Callers check verbose before building info messages, so quiet runs do
+    not format them at all.
+    """
+
+    def __init__(self, verbose=True):
+        self.messages = []
+        self.verbose = verbose
+        self.processing_feedback = QgsProcessingFeedback()
+
+    def cancel(self):
+        self.processing_feedback.cancel()
+
+    def isCanceled(self):
+        return self.processing_feedback.isCanceled()
+
+    def pushInfo(self, info):
+        self.messages.append((False, info))
+
+    def reportError(self, error):
+        self.messages.append((True, error))
+
+    def flush(self, feedback):
+        for is_error, message in self.messages:
+            if is_error:
+                feedback.reportError(message)
+            else:
+                feedback.pushInfo(message)
+        self.messages = []
 
 
 class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
@@ -29,6 +130,7 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
     INPUT_LAYERS = 'INPUT_LAYERS'
     TARGET_CRS = 'TARGET_CRS'
     SAVE_STYLES = 'SAVE_STYLES'
+    TEMP_DIR = 'TEMP_DIR'
     OUTPUT_KMZ = 'OUTPUT_KMZ'
     
     def tr(self, string):
@@ -63,6 +165,7 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
         • Choose target CRS (defaults to project CRS)
         • Option to preserve layer styles in KMZ
         • Specify output location and filename
+        • Optional scratch folder for intermediate files, e.g. on a fast disk
         
         The KMZ file will contain all selected layers with proper styling 
         if the option is enabled.
@@ -100,6 +203,16 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
             )
         )
         
+        # Scratch folder for intermediate files (optional)
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.TEMP_DIR,
+                self.tr('Temporary folder (optional)'),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True
+            )
+        )
+        
         # Output KMZ file
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -117,6 +230,7 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
         target_crs = self.parameterAsCrs(parameters, self.TARGET_CRS, context)
         save_styles = self.parameterAsBool(parameters, self.SAVE_STYLES, context)
         output_kmz = self.parameterAsFileOutput(parameters, self.OUTPUT_KMZ, context)
+        scratch_dir = self.parameterAsFile(parameters, self.TEMP_DIR, context)
         
         if not input_layers:
             raise QgsProcessingException(self.tr('No input layers selected'))
@@ -125,52 +239,85 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
         if not target_crs.isValid():
             target_crs = QgsProject.instance().crs()
             
-        feedback.pushInfo(f'Target CRS: {target_crs.authid()}')
+        # Computed once, the layers compare against it by string
+        target_authid = target_crs.authid()
+        
+        feedback.pushInfo(f'Target CRS: {target_authid}')
         feedback.pushInfo(f'Processing {len(input_layers)} layers')
         feedback.pushInfo(f'Save styles: {save_styles}')
         
-        # Create temporary directory for processing
-        temp_dir = tempfile.mkdtemp()
+        # Create temporary directory for processing, in the chosen scratch
+        # folder or else the Processing temporary folder
+        if not scratch_dir:
+            scratch_dir = QgsProcessingUtils.tempFolder()
+        elif not os.path.isdir(scratch_dir) or not os.access(scratch_dir, os.W_OK):
+            raise QgsProcessingException(
+                self.tr('Temporary folder does not exist or is not writable: {}').format(scratch_dir)
+            )
+        temp_dir = tempfile.mkdtemp(dir=scratch_dir)
+        # Also removed if the algorithm is collected or QGIS exits before
+        # the finally block runs
+        cleanup = weakref.finalize(self, shutil.rmtree, temp_dir, True)
         
         try:
-            # Process each layer
-            processed_files = []
+            # Process the layers in parallel, each one is an independent
+            # KML writer or GDAL call
             total_layers = len(input_layers)
+            results = [None] * total_layers
             
             feedback.pushInfo(f'Starting to process {total_layers} layers...')
             
-            for i, layer in enumerate(input_layers):
-                if feedback.isCanceled():
-                    break
-                    
-                feedback.setProgress(int((i / total_layers) * 90))
-                feedback.pushInfo(f'Processing layer {i+1}/{total_layers}: {layer.name()}')
-                
-                kml_file = None
+            # Layer handlers looked up by exact layer type
+            self._dispatch = {
+                QgsVectorLayer: ('Vector', self._process_vector_layer),
+                QgsRasterLayer: ('Raster', self._process_raster_layer),
+            }
+            
+            # Raster warps already use every core, so leave room for them
+            cpu_count = os.cpu_count() or 1
+            if any(isinstance(layer, QgsRasterLayer) for layer in input_layers):
+                cpu_count = max(1, cpu_count // 2)
+            max_workers = min(cpu_count, total_layers)
+            verbose = total_layers <= QUIET_LAYER_COUNT
+            # One log per layer, created here so the layers can be
+            # cancelled from this thread
+            logs = [_TaskLog(verbose) for _ in input_layers]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(self._process_one, layer, target_crs, target_authid,
+                                    temp_dir, save_styles, logs[i]): i
+                    for i, layer in enumerate(input_layers)
+                }
                 
-                # Process vector layers
-                if isinstance(layer, QgsVectorLayer):
-                    feedback.pushInfo(f'  -> Vector layer detected: {layer.name()}')
-                    kml_file = self._process_vector_layer(
-                        layer, target_crs, temp_dir, save_styles, feedback
-                    )
+                # Wait with a timeout so a cancel is noticed while long
+                # GDAL calls are still running
+                pending = set(futures)
+                done = 0
+                while pending:
+                    finished, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL,
+                                             return_when=FIRST_COMPLETED)
+                    
+                    for future in finished:
+                        i = futures[future]
+                        done += 1
                         
-                # Process raster layers
-                elif isinstance(layer, QgsRasterLayer):
-                    feedback.pushInfo(f'  -> Raster layer detected: {layer.name()}')
-                    kml_file = self._process_raster_layer(
-                        layer, target_crs, temp_dir, save_styles, feedback
-                    )
-                else:
-                    feedback.pushInfo(f'  -> Unsupported layer type: {type(layer).__name__}')
-                    continue
-                
-                # Add to processed files if successful
-                if kml_file and os.path.exists(kml_file):
-                    processed_files.append(kml_file)
-                    feedback.pushInfo(f'  -> Successfully processed: {layer.name()}')
-                else:
-                    feedback.reportError(f'  -> Failed to process: {layer.name()}')
+                        if verbose:
+                            feedback.pushInfo(f'Processing layer {i+1}/{total_layers}: {input_layers[i].name()}')
+                        elif done % SUMMARY_INTERVAL == 0 or done == total_layers:
+                            feedback.setProgressText(f'Processed {done}/{total_layers} layers')
+                        logs[i].flush(feedback)
+                        results[i] = future.result()
+                        feedback.setProgress(int((done / total_layers) * 90))
+                    
+                    if feedback.isCanceled():
+                        for future in pending:
+                            future.cancel()
+                        for log in logs:
+                            log.cancel()
+                        break
+            
+            # Keep the layer order of the input in the KMZ
+            processed_files = [folder_file for folder_file in results if folder_file]
             
             feedback.pushInfo(f'Processing complete. {len(processed_files)} layers successfully processed.')
             
@@ -187,30 +334,117 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
             
         finally:
             # Clean up temporary directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            cleanup()
+            clear_transform_cache()
         
         return {self.OUTPUT_KMZ: output_kmz}
 
-    def _process_vector_layer(self, layer, target_crs, temp_dir, save_styles, feedback):
+    def _process_one(self, layer, target_crs, target_authid, temp_dir, save_styles, log):
+        """Process a single layer on a worker thread, logging to log.
+        
+        Returns the file holding the KML Folder of the layer, or None.
+        """
+        if log.isCanceled():
+            return None
+        
+        handler = self._dispatch.get(type(layer))
+        if handler is None:
+            if log.verbose:
+                log.pushInfo(f'  -> Unsupported layer type: {type(layer).__name__}')
+            return None
+        
+        kind, process = handler
+        if log.verbose:
+            log.pushInfo(f'  -> {kind} layer detected: {layer.name()}')
+        
+        # Empty layers would only add an empty Folder to the KMZ
+        if type(layer) is QgsVectorLayer and layer.featureCount() == 0:
+            if log.verbose:
+                log.pushInfo(f'  -> Skipping empty layer: {layer.name()}')
+            return None
+        
+        kml_file = process(layer, target_crs, target_authid, temp_dir, save_styles, log)
+        
+        # Keep only the Folder of the KML, ready to be added to the KMZ.
+        # The layer handlers only return KML files that exist
+        if kml_file:
+            try:
+                folder_file = self._extract_folder(kml_file, log)
+            except Exception as e:
+                log.reportError(f'Error extracting KML Folder of {layer.name()}: {str(e)}')
+                folder_file = None
+            if folder_file:
+                if log.verbose:
+                    log.pushInfo(f'  -> Successfully processed: {layer.name()}')
+                return folder_file
+        
+        log.reportError(f'  -> Failed to process: {layer.name()}')
+        return None
+
+    def _process_vector_layer(self, layer, target_crs, target_authid, temp_dir, save_styles, feedback):
         """Process a vector layer and convert to KML."""
         
         layer_name = self._sanitize_filename(layer.name())
         # Add unique identifier to avoid filename conflicts
         kml_file = os.path.join(temp_dir, f'{layer_name}_{id(layer)}.kml')
         
-        feedback.pushInfo(f'Processing vector layer: {layer.name()} -> {kml_file}')
+        if feedback.verbose:
+            feedback.pushInfo(f'Processing vector layer: {layer.name()} -> {kml_file}')
         
         try:
             # Set up coordinate transform if needed
             source_crs = layer.crs()
+            source_authid = source_crs.authid()
             transform = None
-            if source_crs != target_crs:
-                transform = QgsCoordinateTransform(source_crs, target_crs, QgsProject.instance())
+            output_layer = layer
+            # Geometryless tables have nothing to transform
+            needs_transform = layer.isSpatial() and not _same_crs(source_crs, source_authid, target_crs, target_authid)
+            if needs_transform and layer.featureCount() > REPROJECT_THRESHOLD:
+                # Large layers are reprojected up front so the writer only
+                # has to serialise the features
+                if feedback.verbose:
+                    feedback.pushInfo(f'Reprojecting {layer.featureCount()} features of {layer.name()}')
+                output_layer = processing.run('native:reprojectlayer', {
+                    'INPUT': layer,
+                    'TARGET_CRS': target_crs,
+                    'OUTPUT': 'memory:'
+                }, context=None, feedback=feedback.processing_feedback)['OUTPUT']
+                if save_styles and layer.renderer():
+                    output_layer.setRenderer(layer.renderer().clone())
+            elif needs_transform:
+                # Custom CRSs without an auth id cannot be cached by key
+                if source_authid and target_authid:
+                    transform = _get_transform(source_authid, target_authid)
+                else:
+                    transform = QgsCoordinateTransform(source_crs, target_crs, QgsProject.instance())
+            
+            # Dense layers are snapped so the KML driver, which has no
+            # precision option, writes at most 7 decimals per coordinate.
+            # They are past REPROJECT_THRESHOLD, so already in the target CRS.
+            # KML is always written in WGS84, so any other target would be
+            # reprojected again by the writer and lose the snapping
+            snap = (layer.isSpatial() and target_authid == 'EPSG:4326'
+                    and layer.featureCount() > SNAP_THRESHOLD)
+            if snap:
+                # Written to disk rather than memory, so a reprojected
+                # memory copy and the snapped one are not both held in RAM
+                snapped_file = os.path.join(temp_dir, f'{layer_name}_{id(layer)}_snapped.gpkg')
+                processing.run('native:snappointstogrid', {
+                    'INPUT': output_layer,
+                    'HSPACING': SNAP_SPACING,
+                    'VSPACING': SNAP_SPACING,
+                    'OUTPUT': snapped_file
+                }, context=None, feedback=feedback.processing_feedback)
+                output_layer = QgsVectorLayer(snapped_file, layer.name(), 'ogr')
+                if save_styles and layer.renderer():
+                    output_layer.setRenderer(layer.renderer().clone())
             
             # Export to KML using QGIS vector file writer
             writer_options = QgsVectorFileWriter.SaveVectorOptions()
             writer_options.driverName = 'KML'
             writer_options.fileEncoding = 'UTF-8'
+            # Lets a cancel from the main thread stop the write
+            writer_options.feedback = feedback.processing_feedback
             
             if transform:
                 writer_options.ct = transform
@@ -220,7 +454,7 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
                 writer_options.symbologyExport = QgsVectorFileWriter.SymbolLayerSymbology
             
             error = QgsVectorFileWriter.writeAsVectorFormatV3(
-                layer,
+                output_layer,
                 kml_file,
                 QgsProject.instance().transformContext(),
                 writer_options
@@ -231,8 +465,9 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
                 return None
             
             # Verify KML file was created and has content
-            if os.path.exists(kml_file) and os.path.getsize(kml_file) > 0:
-                feedback.pushInfo(f'Successfully created KML for vector: {layer.name()}')
+            if _has_content(kml_file):
+                if feedback.verbose:
+                    feedback.pushInfo(f'Successfully created KML for vector: {layer.name()}')
                 return kml_file
             else:
                 feedback.reportError(f'KML file not created or empty for layer: {layer.name()}')
@@ -242,29 +477,35 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
             feedback.reportError(f'Error processing vector layer {layer.name()}: {str(e)}')
             return None
 
-    def _process_raster_layer(self, layer, target_crs, temp_dir, save_styles, feedback):
+    def _process_raster_layer(self, layer, target_crs, target_authid, temp_dir, save_styles, feedback):
         """Process a raster layer and convert to KML with ground overlay."""
         
         layer_name = self._sanitize_filename(layer.name())
         
         try:
             # Create unique filenames to avoid conflicts
-            temp_tiff = os.path.join(temp_dir, f'{layer_name}_{id(layer)}_temp.tif')
+            temp_vrt = os.path.join(temp_dir, f'{layer_name}_{id(layer)}_temp.vrt')
             kml_file = os.path.join(temp_dir, f'{layer_name}_{id(layer)}.kml')
             
-            feedback.pushInfo(f'Processing raster layer: {layer.name()} -> {kml_file}')
+            if feedback.verbose:
+                feedback.pushInfo(f'Processing raster layer: {layer.name()} -> {kml_file}')
             
-            # First, reproject raster if needed
-            if layer.crs() != target_crs:
+            # First, reproject raster if needed. The warp is written as a
+            # VRT, so translate reads the warped pixels without a full
+            # intermediate GeoTIFF on disk
+            source_crs = layer.crs()
+            if not _same_crs(source_crs, source_crs.authid(), target_crs, target_authid):
                 gdal_params = {
                     'INPUT': layer,
                     'TARGET_CRS': target_crs,
-                    'OUTPUT': temp_tiff
+                    'MULTITHREADING': True,
+                    'EXTRA': '-wo NUM_THREADS=ALL_CPUS',
+                    'OUTPUT': temp_vrt
                 }
                 
                 result = processing.run('gdal:warpreproject', gdal_params, 
-                                      context=None, feedback=feedback)
-                input_for_kml = temp_tiff
+                                      context=None, feedback=feedback.processing_feedback)
+                input_for_kml = temp_vrt
             else:
                 input_for_kml = layer
             
@@ -276,15 +517,18 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
             }
             
             result = processing.run('gdal:translate', translate_params, 
-                                  context=None, feedback=feedback)
+                                  context=None, feedback=feedback.processing_feedback)
             
-            # Clean up temporary tiff
-            if os.path.exists(temp_tiff):
-                os.remove(temp_tiff)
+            # Clean up temporary warped VRT
+            try:
+                os.remove(temp_vrt)
+            except FileNotFoundError:
+                pass
             
             # Verify KML file was created
-            if os.path.exists(kml_file) and os.path.getsize(kml_file) > 0:
-                feedback.pushInfo(f'Successfully created KML for raster: {layer.name()}')
+            if _has_content(kml_file):
+                if feedback.verbose:
+                    feedback.pushInfo(f'Successfully created KML for raster: {layer.name()}')
                 return kml_file
             else:
                 feedback.reportError(f'KML file not created or empty for layer: {layer.name()}')
@@ -294,34 +538,65 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
             feedback.reportError(f'Error processing raster layer {layer.name()}: {str(e)}')
             return None
 
-    def _create_kmz_file(self, kml_files, output_kmz, feedback):
-        """Create KMZ file from multiple KML files."""
+    def _extract_folder(self, kml_file, feedback):
+        """Write the first <Folder> block of a KML file to a .frag file
+        next to it and return its path, or None if there is no Folder."""
+        
+        folder_file = os.path.splitext(kml_file)[0] + '.frag'
+        # Map the KML instead of reading it, find() then scans the pages
+        # in place and the slice is written without a copy
+        with open(kml_file, 'rb') as kml, \
+                mmap.mmap(kml.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = mapped.find(FOLDER_START)
+            end = mapped.find(FOLDER_END, start) if start != -1 else -1
+            if end == -1:
+                feedback.reportError(
+                    f'No <Folder> found in {os.path.basename(kml_file)}, skipping'
+                )
+                return None
+            with open(folder_file, 'wb') as out, memoryview(mapped) as view, \
+                    view[start:end + len(FOLDER_END)] as folder:
+                out.write(folder)
+        
+        os.remove(kml_file)
+        return folder_file
+
+    def _create_kmz_file(self, folder_files, output_kmz, feedback):
+        """Create KMZ file from the KML Folders of the layers."""
         
         try:
-            # Create KMZ archive
-            with zipfile.ZipFile(output_kmz, 'w', zipfile.ZIP_DEFLATED) as kmz:
-                
-                # Create simple master KML as string
-                master_kml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-                master_kml += '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
-                master_kml += '  <Document>\n'
-                master_kml += f'    <name>{os.path.splitext(os.path.basename(output_kmz))[0]}</name>\n'
-                
-                # Add each KML file
-                for kml_file in kml_files:
-                    if os.path.exists(kml_file):
-                        with open(kml_file, 'r', encoding='utf-8') as f:
-                            kml_content = f.read()
-                        folder_match = re.search(r'<Folder>.*?</Folder>', kml_content, re.DOTALL).group(0)
-
-                        master_kml += folder_match
+            # Create KMZ archive, stored by default since raster tiles are
+            # already compressed; only the KML is deflated
+            with zipfile.ZipFile(output_kmz, 'w', zipfile.ZIP_STORED) as kmz:
                 
-                master_kml += '  </Document>\n'
-                master_kml += '</kml>'
+                doc_info = zipfile.ZipInfo('doc.kml', time.localtime()[:6])
+                doc_info.compress_type = zipfile.ZIP_DEFLATED
                 
-                kmz.writestr('doc.kml', master_kml.encode('utf-8'))
+                # Stream the master KML straight into the archive
+                with kmz.open(doc_info, 'w', force_zip64=True) as out:
+                    out.write(KML_HEADER)
+                    name = os.path.splitext(os.path.basename(output_kmz))[0]
+                    out.write(f'    <name>{name}</name>\n'.encode('utf-8'))
+                    
+                    # Add the Folder of each layer, copied as raw bytes
+                    # since the layer KMLs are UTF-8 like the master. One
+                    # buffer is reused for every chunk of every fragment
+                    view = memoryview(bytearray(CHUNK_SIZE))
+                    for folder_file in folder_files:
+                        try:
+                            folder = open(folder_file, 'rb')
+                        except FileNotFoundError:
+                            continue
+                        with folder:
+                            while True:
+                                read = folder.readinto(view)
+                                if not read:
+                                    break
+                                out.write(view[:read])
+                    
+                    out.write(KML_FOOTER)
                 
-            feedback.pushInfo(f'KMZ archive created with {len(kml_files)} layers')
+            feedback.pushInfo(f'KMZ archive created with {len(folder_files)} layers')
             
         except Exception as e:
             raise QgsProcessingException(f'Error creating KMZ file: {str(e)}')
@@ -329,12 +604,5 @@ class MultipleLayersToKmzAlgorithm(QgsProcessingAlgorithm):
     def _sanitize_filename(self, filename):
         """Sanitize filename for use in file system."""
         
-        # Remove invalid characters
-        filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
-        # Remove leading/trailing spaces and dots
-        filename = filename.strip(' .')
-        # Limit length
-        if len(filename) > 50:
-            filename = filename[:50]
-        
-        return filename if filename else 'layer'
\ No newline at end of file
+        # Replace invalid characters, strip spaces and dots and limit length
+        return _INVALID_FN.sub('_', filename).strip(' .')[:50] or 'layer'
@@ -0,0 +1,64 @@
+"""
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import QgsProcessingException
+
+# Number of photos read ahead while the previous one is written to the KMZ
+PHOTO_READ_AHEAD = 4
+
+# Photos larger than this are not read ahead but streamed into the KMZ by
+# ZipFile.write, so the read ahead holds at most
+# PHOTO_READ_AHEAD * MAX_READ_AHEAD_SIZE bytes
+MAX_READ_AHEAD_SIZE = 32 * 1024 * 1024
+
+
+def write_photos(kmz, photos):
+    """Add (photo_path, arcname, compress_type) photos to the KMZ, reading
+    the next files in the background while the current one is written.
+
+    The KML already references every photo, so a photo that cannot be added
+    fails the run rather than leaving a broken link in the KMZ.
+    """
+    import zipfile
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    def read_photo(photo_path, arcname):
+        zinfo = zipfile.ZipInfo.from_file(photo_path, arcname)
+        if zinfo.file_size > MAX_READ_AHEAD_SIZE:
+            return zinfo, None
+        with open(photo_path, 'rb') as f:
+            return zinfo, f.read()
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=PHOTO_READ_AHEAD) as executor:
+        for photo_path, arcname, compress_type in photos:
+            pending.append((photo_path, compress_type, executor.submit(read_photo, photo_path, arcname)))
+            if len(pending) < PHOTO_READ_AHEAD:
+                continue
+            write_photo(kmz, *pending.popleft())
+
+        while pending:
+            write_photo(kmz, *pending.popleft())
+
+
+def write_photo(kmz, photo_path, compress_type, future):
+    """Write a photo read by write_photos() to the KMZ"""
+    try:
+        zinfo, data = future.result()
+        if data is None:
+            # Too large to read ahead, streamed from the file instead
+            kmz.write(photo_path, zinfo.filename, compress_type)
+            return
+        zinfo.compress_type = compress_type
+        kmz.writestr(zinfo, data, compresslevel=kmz.compresslevel)
+    except OSError as e:
+        raise QgsProcessingException(f'Failed to add {photo_path}: {str(e)}') from e